@@ -6,21 +6,32 @@
 .. moduleauthor:: Timothy Helton <tim@icompleteplanet.com>
 """
 
-import datetime as dt
+import csv
 import functools
-import gzip
+import io
 import os
-import shutil
 
 import numpy as np
 import psycopg2
 
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
 
 __version__ = '1.1.0'
 
 
 def status():
-    """Decorator: Provide status for method execution."""
+    """Decorator: Provide status for method execution.
+
+    Methods are returned unwrapped if Python is run with optimizations (-O) \
+        or the environment variable ICP_QUIET is set to 1.
+    """
+    if not __debug__ or os.environ.get('ICP_QUIET') == '1':
+        return lambda func: func
+
     def decorator(func):
         @functools.wraps(func)
         def wrapped(*args, **kwargs):
@@ -40,8 +51,8 @@ class PostgresInitialize:
 
     :Attributes:
 
-        - **city**: *ndarray* all USA city names corresponding to every postal \
-            code
+        - **buffer_size**: *int* number of bytes read per chunk when \
+            streaming data to the database (default: 128 KiB)
         - **conn**: *psycopg2.extensions.connection* database connection object
         - **country**: *ndarray* two letter abbreviation and full name for \
             every country in the world
@@ -52,18 +63,14 @@ class PostgresInitialize:
         - **db_name**: *str* name of PostgreSQL database (default: iCP_events)
         - **db_pwd**: *str* password for PostgreSQL database user
         - **db_user**: *str* name of PostgreSQL database user
-        - **latitude**: *ndarray* all USA latitude values corresponding to \
-            every postal code
-        - **location_data**: *ndarray* composite of all USA cities, states, \
-            latitude and longitude values for every corresponding postal code
-        - **longitude**: *ndarray* all USA longitude values corresponding to \
-            every postal code
-        - **state**: *ndarray* all USA states
-        - **postal_code**: *ndarray* all USA postal codes
-        - **time**: *list* times for a nominal day spaced every five minutes
+        - **staging**: *list* name and data type of every field in the \
+            location staging table, in csv column order
+        - **table_names**: *list* names of all tables created in the database
+        - **time**: *ndarray* times formatted as HH:MM:SS for a nominal day \
+            spaced every five minutes
     """
     def __init__(self):
-        self.city = None
+        self.buffer_size = 128 * 1024
         self.conn = None
         self.country = None
         self.csv_file = None
@@ -72,11 +79,15 @@ class PostgresInitialize:
         self.db_name = 'iCP_events'
         self.db_pwd = None
         self.db_user = None
-        self.latitude = None
-        self.location_data = None
-        self.longitude = None
-        self.state = None
-        self.postal_code = None
+        self.staging = ['postal_code CHAR(5)',
+                        'city TEXT',
+                        'state_name TEXT',
+                        'state CHAR(2)',
+                        'county TEXT',
+                        'latitude DOUBLE PRECISION',
+                        'longitude DOUBLE PRECISION',
+                        'unused TEXT']
+        self.table_names = None
         self.time = None
 
     def table_select(self, table_name, return_field='*', search_field=None,
@@ -126,6 +137,37 @@ class PostgresInitialize:
                                                fields=', '.join(field_names),
                                                values=values)
 
+    def table_copy(self, name, field_names, records):
+        """Stream records into a PostgreSQL table with COPY FROM STDIN.
+
+        :param str name: name of table to append
+        :param field_names: names of fields
+        :type: str or list
+        :param records: sequence of record tuples matching field_names
+        """
+        if isinstance(field_names, str):
+            field_names = [field_names]
+
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerows(records)
+        buffer.seek(0)
+
+        cmd = 'COPY {table_name} ({fields}) FROM STDIN WITH (FORMAT csv);'
+        self.cur.copy_expert(cmd.format(table_name=name,
+                                        fields=', '.join(field_names)),
+                             buffer, size=self.buffer_size)
+
+    def table_distinct(self, name, field):
+        """Populate a PostgreSQL table with unique values of a staged field.
+
+        :param str name: name of table to append
+        :param str field: name of location staging table field
+        """
+        cmd = '''INSERT INTO {table_name} (value)
+                 SELECT DISTINCT {field} FROM location_staging
+                 ORDER BY {field};'''
+        self.cur.execute(cmd.format(table_name=name, field=field))
+
     def get_password(self):
         """Get database user password."""
         self.db_pwd = input('Enter database password: ')
@@ -139,7 +181,6 @@ class PostgresInitialize:
     def initiate_db(self):
         """Populate the PostgreSQL database."""
         self.load_countries()
-        self.load_locations()
         self.load_times()
 
         self.get_user()
@@ -147,6 +188,7 @@ class PostgresInitialize:
 
         self.psql_connection()
         self.psql_tables()
+        self.psql_staging()
         self.psql_city()
         self.psql_country()
         self.psql_latitude()
@@ -155,88 +197,66 @@ class PostgresInitialize:
         self.psql_state()
         self.psql_times()
         self.psql_address()
+        self.psql_staging_drop()
+        self.psql_logged()
+        self.psql_constraints()
         self.conn.commit()
 
     @status()
     def load_countries(self):
         """Load countries from self.csv file."""
         self.csv_file = 'countries.csv'
-        self.unzip()
-        country = np.genfromtxt(self.csv_file, dtype=[('abbr', 'U2'),
-                                                      ('name', 'U50')],
+        country = np.genfromtxt(io.BytesIO(self.read_csv()),
+                                dtype=[('abbr', 'U2'), ('name', 'U50')],
                                 delimiter=', ', usecols=[0, 1])
-        self.zip_file()
         self.country = country.view(np.recarray)
 
-    @status()
-    def load_locations(self):
-        """Load location data from self.csv file."""
-        self.csv_file = 'us_postal_codes.csv'
-        self.unzip()
-        loc = np.genfromtxt(self.csv_file, dtype=[('postal_code', 'U5'),
-                                                  ('city', 'U30'),
-                                                  ('state', 'U2'),
-                                                  ('latitude', 'U9'),
-                                                  ('longitude', 'U9')],
-                            delimiter=',', skip_header=1,
-                            usecols=[0, 1, 3, 5, 6])
-        self.zip_file()
-
-        self.location_data = loc.view(np.recarray)
-        self.city = np.unique(self.location_data.city)
-        self.state = np.unique(self.location_data.state)
-        self.postal_code = np.unique(self.location_data.postal_code)
-        self.latitude = np.unique(self.location_data.latitude)
-        self.longitude = np.unique(self.location_data.longitude)
-
     @status()
     def load_times(self):
-        """Create list of times for a day spaced five minutes apart"""
-        day = dt.datetime(1, 1, 1)
-        delta = dt.timedelta(minutes=5)
-        day_time = [day + delta * x for x in range(288)]
-        self.time = [x.time() for x in day_time]
+        """Create array of times for a day spaced five minutes apart"""
+        day = np.arange('1970-01-01T00:00', '1970-01-02T00:00',
+                        np.timedelta64(5, 'm'), dtype='datetime64[m]')
+        day_time = np.datetime_as_string(day, unit='s')
+        self.time = np.char.partition(day_time, 'T')[:, 2].astype('U8')
 
     def psql_connection(self):
         """Connect to PostgreSQL database and establish a cursor."""
         self.conn = psycopg2.connect(database=self.db_name, user=self.db_user,
                                      password=self.db_pwd)
         self.cur = self.conn.cursor()
+        # Single bulk load transaction, no need to wait on the WAL flush
+        self.cur.execute('SET LOCAL synchronous_commit = OFF;')
 
     @status()
     def psql_tables(self):
         """Create PostgreSQL tables."""
-        def table_create(name, schema, serial=False, unique=None):
+        def table_create(name, schema, serial=False):
             """Return command to create a table in a PostgreSQL database.
 
+            Tables are created unlogged and without unique constraints to \
+                skip WAL writes and index maintenance during the bulk load; \
+                see psql_logged and psql_constraints.
+
             :param str name: name of table
             :param list schema: schema of table provided in name data type \
                 pairs [(n_1, dt_1), (n_2, dt_2]
             :param bool serial: a serialized index will be created for the \
                 table and used as the primary key if True
-            :param list unique: field names that define a unique record for \
-                the table
             :return: command to create a table
             :rtype: str
             """
-            base_cmd = 'CREATE TABLE {name} ('.format(name=name)
+            base_cmd = 'CREATE UNLOGGED TABLE {name} ('.format(name=name)
 
             if serial:
-                serial_cmd = 'id SERIAL UNIQUE NOT NULL PRIMARY KEY,'
+                serial_cmd = 'id SERIAL NOT NULL PRIMARY KEY,'
             else:
                 serial_cmd = ''
 
             schema_cmd = ', '.join(schema)
 
-            if unique:
-                unique_cmd = ',UNIQUE ({field})'.format(field=', '.join(unique))
-            else:
-                unique_cmd = ''
-
-            return '{base}{serial}{schema}{unique});'.format(base=base_cmd,
-                                                             serial=serial_cmd,
-                                                             schema=schema_cmd,
-                                                             unique=unique_cmd)
+            return '{base}{serial}{schema});'.format(base=base_cmd,
+                                                     serial=serial_cmd,
+                                                     schema=schema_cmd)
 
         def table_drop(name):
             """Return command to drop a table from a PostgreSQL database.
@@ -269,6 +289,8 @@ class PostgresInitialize:
                      ('event_time', 'INTEGER'),
                      ('url', 'INTEGER')]
 
+        self.table_names = list(tables) + ['address', 'events']
+
         # Serial Tables
         [self.cur.execute(table_drop(x)) for x in tables]
         [self.cur.execute(table_create(x, tables[x], serial=True))
@@ -280,112 +302,114 @@ class PostgresInitialize:
                                       [' '.join(x) for x in composite
                                        if x[0] in ('city', 'state',
                                                    'postal_code', 'latitude',
-                                                   'longitude')],
-                                      unique= ['city', 'state', 'postal_code']))
+                                                   'longitude')]))
         self.cur.execute(table_create('events',
-                                      [' '.join(x) for x in composite],
-                                      unique=['event', 'city', 'postal_code',
-                                              'event_date']))
+                                      [' '.join(x) for x in composite]))
+
+        # Staging Table
+        self.cur.execute(table_drop('location_staging'))
+        self.cur.execute(table_create('location_staging', self.staging))
 
     @status()
     def psql_address(self):
         """Populate composite PostreSQL address table."""
-        def idx_sub(name, translate):
-            """Replace record array strings with database index values.
-
-            :param str name: name of field to modify
-            :param list translate: list of tuples to define replace values \
-                with new values (new, replace)
-            """
-            nonlocal addresses
-            field = eval('addresses.{}'.format(name))
-            mask = eval('self.location_data.{}'.format(name))
-
-            print('   {}'.format(name))
-            for values in self.table_select(name):
-                field[mask == str(values[1])] = values[0]
-
         fields = ['postal_code', 'city', 'state', 'latitude', 'longitude']
-        addresses = np.recarray(self.location_data.shape,
-                                dtype=list(zip(fields, ['U6'] * len(fields))))
-
-        for field in fields:
-            idx_sub(field, self.table_select(field))
-
-        for a in addresses:
-            self.cur.execute(self.table_insert('address', fields), a)
-
-        # for location in self.location_data:
-            # city_id = self.table_find_id('city', 'value', location.city)
-            # state_id = self.table_find_id('state', 'value', location.state)
-            # postal_code_id = self.table_find_id('postal_code', 'value',
-                                                # location.postal_code)
-            # latitude_id = self.table_find_id('latitude', 'value',
-                                             # location.latitude)
-            # longitude_id = self.table_find_id('longitude', 'value',
-                                              # location.longitude)
-            # field_ids = (city_id, state_id, postal_code_id, latitude_id,
-                         # longitude_id)
+        joins = ['JOIN {x} ON {x}.value = location_staging.{x}'.format(x=x)
+                 for x in fields]
 
-            # self.cur.execute(self.table_insert('address', fields), field_ids)
+        cmd = '''INSERT INTO address ({fields})
+                 SELECT {ids} FROM location_staging
+                 {joins};'''
+        self.cur.execute(cmd.format(fields=', '.join(fields),
+                                    ids=', '.join(['{}.id'.format(x)
+                                                   for x in fields]),
+                                    joins=' '.join(joins)))
 
     @status()
     def psql_city(self):
         """Populate PostgreSQL city table."""
-        [self.cur.execute(self.table_insert('city', 'value'), (x, ))
-         for x in self.city]
+        self.table_distinct('city', 'city')
+
+    @status()
+    def psql_constraints(self):
+        """Add unique constraints to populated PostgreSQL composite tables."""
+        unique = {'address': ['city', 'state', 'postal_code'],
+                  'events': ['event', 'city', 'postal_code', 'event_date']}
+
+        cmd = '''ALTER TABLE {name}
+                 ADD CONSTRAINT {name}_unique UNIQUE ({field});'''
+        [self.cur.execute(cmd.format(name=x, field=', '.join(unique[x])))
+         for x in unique]
 
     @status()
     def psql_country(self):
         """Populate PostgreSQL country table."""
-        [self.cur.execute(self.table_insert('country', ['value', 'name']),
-                          (x, y)) for (x, y) in self.country]
+        self.table_copy('country', ['value', 'name'], self.country.tolist())
 
     @status()
     def psql_latitude(self):
         """Populate PostgreSQL latitude table."""
-        [self.cur.execute(self.table_insert('latitude', 'value'), (x, ))
-         for x in self.latitude]
+        self.table_distinct('latitude', 'latitude')
 
     @status()
     def psql_longitude(self):
         """Populate PostgreSQL longitude table."""
-        [self.cur.execute(self.table_insert('longitude', 'value'), (x, ))
-         for x in self.longitude]
+        self.table_distinct('longitude', 'longitude')
+
+    @status()
+    def psql_logged(self):
+        """Enable write-ahead logging for all PostgreSQL tables."""
+        [self.cur.execute('ALTER TABLE {} SET LOGGED;'.format(x))
+         for x in self.table_names]
 
     @status()
     def psql_postal_code(self):
         """Populate PostgreSQL postal code table."""
-        [self.cur.execute(self.table_insert('postal_code', 'value'), (x, ))
-         for x in self.postal_code]
+        self.table_distinct('postal_code', 'postal_code')
+
+    @status()
+    def psql_staging(self):
+        """Copy location csv file into PostgreSQL staging table."""
+        self.csv_file = 'us_postal_codes.csv'
+        # The final record of the source file is missing its last field
+        csv_data = self.read_csv().rstrip(b'\r\n')
+        missing = (len(self.staging) - 1
+                   - csv_data[csv_data.rfind(b'\n'):].count(b','))
+        csv_data += b',' * max(missing, 0)
+
+        cmd = 'COPY location_staging FROM STDIN WITH (FORMAT csv, HEADER);'
+        self.cur.copy_expert(cmd, io.BytesIO(csv_data), size=self.buffer_size)
+
+    @status()
+    def psql_staging_drop(self):
+        """Remove PostgreSQL location staging table."""
+        self.cur.execute('DROP TABLE location_staging;')
 
     @status()
     def psql_state(self):
         """Populate PostgreSQL state table."""
-        [self.cur.execute(self.table_insert('state', 'value'), (x, ))
-         for x in self.state]
+        self.table_distinct('state', 'state')
 
     @status()
     def psql_times(self):
         """Populate PostgreSQL times table."""
-        [self.cur.execute(self.table_insert('event_time', 'value'), (x, ))
-         for x in self.time]
+        self.table_copy('event_time', 'value',
+                        self.time.reshape(-1, 1).tolist())
 
-    def unzip(self):
-        """Unzip csv file if compression attribute csv_zipped is True."""
-        if self.csv_zipped:
-            with gzip.open('{}.gz'.format(self.csv_file), 'r') as f:
-                csv_data = f.read()
-                csv_data = csv_data.decode().replace('\r', '')
-            with open(self.csv_file, 'w') as f:
-                f.write(csv_data)
+    def read_csv(self):
+        """Return csv file contents as bytes.
 
-    def zip_file(self):
-        """Zip csv file after data has been extracted."""
-        if not self.csv_zipped:
-            with open(self.csv_file, 'rb') as f_in:
-                with gzip.open('{}.gz'.format(self.csv_file), 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
+        The file is decompressed in memory if compression attribute \
+            csv_zipped is True.
 
-        os.remove(self.csv_file)
+        :returns: contents of csv file
+        :rtype: bytes
+        """
+        if self.csv_zipped:
+            with gzip.open('{}.gz'.format(self.csv_file), 'rb') as f:
+                csv_data = f.read()
+        else:
+            with open(self.csv_file, 'rb') as f:
+                csv_data = f.read()
 
+        return csv_data